@@ -7,21 +7,57 @@ import os
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 SKILL_MODEL = os.getenv("SKILL_MODEL", "gpt-4.1-mini")
 DIFF_MODEL  = os.getenv("DIFF_MODEL",  "gpt-4.1-mini")
+SCORE_MODEL = os.getenv("SCORE_MODEL", DIFF_MODEL)
+# Cheap first-pass judge for comparisons; answers below DIFF_ROUTER_MIN_PROB escalate to DIFF_MODEL.
+# Set DIFF_ROUTER_MODEL="" to send everything to DIFF_MODEL.
+DIFF_ROUTER_MODEL = os.getenv("DIFF_ROUTER_MODEL", "gpt-4o-mini")
+DIFF_ROUTER_MIN_PROB = float(os.getenv("DIFF_ROUTER_MIN_PROB", "0.9"))
+
+# System prompt variant: "full" or "compact" (terser; switch after prompt_ab.py shows no distribution shift)
+PROMPT_VARIANT = os.getenv("PROMPT_VARIANT", "full")
+
+# Near-duplicate skill-tag reuse (semantic_cache.py; needs faiss-cpu + sentence-transformers)
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_MODEL = os.getenv("SEMANTIC_CACHE_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))  # cosine similarity
 
 # Concurrency (tune as you see fit; very high tiers can go higher)
 MAX_WORKERS_SKILL = int(os.getenv("MAX_WORKERS_SKILL", "128"))
 MAX_WORKERS_DIFF  = int(os.getenv("MAX_WORKERS_DIFF", "128"))
 
+# Post chat requests as orjson bytes straight through httpx (pre-encoded system prompts) instead of via the SDK
+RAW_HTTP_REQUESTS = os.getenv("RAW_HTTP_REQUESTS", "0") == "1"
+
+# Client-side rate limits (starting budget; snapped to x-ratelimit-* response headers)
+RATE_LIMIT_RPM = int(os.getenv("RATE_LIMIT_RPM", "5000"))
+RATE_LIMIT_TPM = int(os.getenv("RATE_LIMIT_TPM", "4000000"))
+
 # Paths
 DATA_DIR = os.getenv("DATA_DIR", "./data")
 RAW_ORCA_PATH = os.path.join(DATA_DIR, "orca_math_word_problems_200k.jsonl")
 TAGGED_PATH   = os.path.join(DATA_DIR, "tagged.jsonl")
-COMPARE_CACHE = os.path.join(DATA_DIR, "compare_cache.jsonl")
+COMPARE_CACHE = os.path.join(DATA_DIR, "compare_cache.sqlite")
+SCORE_CACHE   = os.path.join(DATA_DIR, "score_cache.bin")             # length-prefixed frames (utils.append_framed)
 FINAL_PATH    = os.path.join(DATA_DIR, "final_tagged_ranked.jsonl")
+SEMANTIC_CACHE_INDEX = os.path.join(DATA_DIR, "semantic_cache.faiss")   # + .json sidecar (tags, records covered)
+LLM_CACHE     = os.getenv("LLM_CACHE", os.path.join(DATA_DIR, "llm_cache.sqlite"))  # "" disables the response cache
+LLM_NEGATIVE_TTL = float(os.getenv("LLM_NEGATIVE_TTL", "600"))        # seconds a permanently failed request fails fast
 
 os.makedirs(DATA_DIR, exist_ok=True)
 
 # Batch sizes
 SKILL_BATCH_SIZE = int(os.getenv("SKILL_BATCH_SIZE", "50"))
-DIFF_BATCH_SIZE  = int(os.getenv("DIFF_BATCH_SIZE", "200"))
+SKILL_TAG_WORKERS = int(os.getenv("SKILL_TAG_WORKERS", "4"))             # batches tagged concurrently while streaming
+JSONL_FSYNC_SECONDS = float(os.getenv("JSONL_FSYNC_SECONDS", "5"))       # checkpoint interval for tagged output
+JSONL_IO_URING = os.getenv("JSONL_IO_URING", "0") == "1"                  # io_uring appends (Linux >= 5.6 + liburing)
+SKILL_EXAMPLES = int(os.getenv("SKILL_EXAMPLES", "12"))                  # few-shot examples in the skill prompt
+SKILL_EXAMPLES_REFRESH = int(os.getenv("SKILL_EXAMPLES_REFRESH", "0"))   # re-pick every N batches once full (0 = never)
+DIFF_BATCH_SIZE  = int(os.getenv("DIFF_BATCH_SIZE", "50"))   # comparisons per batched prompt
+SCORE_BATCH_SIZE = int(os.getenv("SCORE_BATCH_SIZE", "1000")) # items scored between checkpoints
 RETRY_LIMIT = int(os.getenv("RETRY_LIMIT", "6"))
+
+# OpenAI Batch API (download_and_tag.py --batch)
+BATCH_API_MAX_REQUESTS = int(os.getenv("BATCH_API_MAX_REQUESTS", "50000"))  # per-batch cap imposed by OpenAI
+BATCH_API_MAX_BYTES = int(os.getenv("BATCH_API_MAX_BYTES", str(190 << 20)))  # input file cap (OpenAI: 200 MB)
+BATCH_API_LOG = os.path.join(DATA_DIR, "skill_batches.jsonl")                 # submitted/collected batch ids
+BATCH_POLL_SECONDS = int(os.getenv("BATCH_POLL_SECONDS", "60"))
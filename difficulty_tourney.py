@@ -1,22 +1,24 @@
 
 """
 Compute a total preorder of difficulty using pairwise OpenAI comparisons.
+- First scores every item 1–10 in one O(n) pass (cached to SCORE_CACHE) and buckets by score;
+  pairwise comparisons only order items within a bucket.
 - Uses a merge-sort–style tournament that naturally recurses.
 - Ties "=" create equivalence groups.
-- Caches pairwise results to JSONL so we never re-ask the same comparison.
-- Highly parallel at each merge layer.
+- Caches pairwise results in SQLite (point lookups, no startup scan) so we never re-ask the same comparison.
+- Highly parallel at each merge layer (asyncio + AsyncOpenAI, bounded by a semaphore): every merge
+  runs as its own coroutine and comparisons requested together are sent as one wave of batched prompts.
 
 usage:
   OPENAI_API_KEY=... python difficulty_tourney.py
 """
 from __future__ import annotations
-import os, json, itertools
+import os, re, json, math, itertools, asyncio, sqlite3
 from typing import List, Tuple, Dict, Any
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 from config import *
-from utils import append_jsonl, read_jsonl, get_client, with_backoff, DIFF_SYSTEM_TEMPLATE, build_diff_user, pair_key
+from utils import append_jsonl, append_framed, flush_jsonl, read_jsonl, read_framed, get_async_client, limited_create, with_backoff_async, cached_completion, PERMANENT_ERRORS, CachedFailure, DIFF_SYSTEM_TEMPLATE, build_diff_user, build_diff_user_batch, parse_diff_batch, SCORE_SYSTEM_TEMPLATE, build_score_user, pair_key, unpack_pair_key, usage_stats, usage_summary
 
 # ---- Load items (from TAGGED_PATH if present, else raw) ----
 def load_items(limit: int | None = None) -> List[dict]:
@@ -31,59 +33,263 @@ def load_items(limit: int | None = None) -> List[dict]:
     return out
 
 # ---- Comparison cache ----
-def load_compare_cache() -> Dict[str, str]:
-    cache: Dict[str,str] = {}
-    for rec in read_jsonl(COMPARE_CACHE):
-        k = rec.get("k"); r = rec.get("r")
-        if k and r in ("<",">","="):
-            cache[k] = r
-    return cache
-
-def cache_write(pairs: List[Tuple[Tuple[int,int], str]]):
-    recs = [{"k": pair_key(i,j), "r": r} for (i,j), r in pairs]
-    append_jsonl(COMPARE_CACHE, recs)
+# Cached symbols are canonical: they answer "is min(i,j) easier than max(i,j)?" so that (i,j) and
+# (j,i) share one entry. Read them back through oriented().
+_FLIP = {"<": ">", ">": "<", "=": "="}
+
+def oriented(sym: str, i: int, j: int) -> str:
+    """Convert between the canonical symbol for pair_key(i,j) and the symbol for i-vs-j (self-inverse)."""
+    return sym if i <= j else _FLIP[sym]
+
+_SYM_CODE = {"<": -1, "=": 0, ">": 1}
+_CODE_SYM = {v: k for k, v in _SYM_CODE.items()}
+
+class CompareCache:
+    """Canonical symbols keyed by pair_key, stored in SQLite as cmp(i, j, r) with i < j and r in
+       -1/0/1. Lookups are point queries, so nothing is loaded up front; update() writes one
+       transaction per call (one per wave)."""
+    def __init__(self, path: str = COMPARE_CACHE):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS cmp(i INTEGER, j INTEGER, r INTEGER, PRIMARY KEY(i,j)) WITHOUT ROWID")
+
+    def _insert(self, canon: Dict[int, str]):
+        self.db.executemany("INSERT OR REPLACE INTO cmp(i, j, r) VALUES (?, ?, ?)",
+                            ((*unpack_pair_key(k), _SYM_CODE[s]) for k, s in canon.items()))
+
+    def get(self, k: int, default: str | None = None) -> str | None:
+        row = self.db.execute("SELECT r FROM cmp WHERE i=? AND j=?", unpack_pair_key(k)).fetchone()
+        return default if row is None else _CODE_SYM[row[0]]
+
+    def __contains__(self, k: int) -> bool:
+        return self.get(k) is not None
+
+    def __getitem__(self, k: int) -> str:
+        sym = self.get(k)
+        if sym is None:
+            raise KeyError(k)
+        return sym
+
+    def update(self, canon: Dict[int, str]):
+        if canon:
+            with self.db:
+                self._insert(canon)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 # ---- OpenAI comparator ----
-def compare_many(client: OpenAI, items: List[dict], idx_pairs: List[Tuple[int,int]]) -> Dict[Tuple[int,int], str]:
-    results: Dict[Tuple[int,int], str] = {}
-    def do_pair(i,j):
-        p1,a1 = items[i]["question"], items[i]["answer"]
-        p2,a2 = items[j]["question"], items[j]["answer"]
-        user = build_diff_user(p1,a1,p2,a2)
-        def _call():
-            resp = client.chat.completions.create(
-                model=DIFF_MODEL,
+# Shared by every concurrent compare/score call so buckets sorted in parallel stay within MAX_WORKERS_DIFF.
+_sem = asyncio.Semaphore(MAX_WORKERS_DIFF)
+# Comparisons currently in flight, keyed by pair_key; each resolves to the canonical symbol.
+_pending: Dict[int, asyncio.Future] = {}
+
+async def compare_many(client: AsyncOpenAI, items: List[dict], idx_pairs: List[Tuple[int,int]], cache: CompareCache | None = None) -> Dict[Tuple[int,int], str]:
+    """Return the symbol for each (i,j) in idx_pairs, read as "i vs j". Cached pairs are answered
+       locally and pairs already in flight (in either order) are awaited, so every logical pair has
+       exactly one outstanding request."""
+    canon: Dict[int,str] = {}
+    waiting: Dict[int, asyncio.Future] = {}
+    new: List[Tuple[int,int]] = []
+    loop = asyncio.get_running_loop()
+    for (i,j) in idx_pairs:
+        k = pair_key(i,j)
+        if k in canon or k in waiting:
+            continue
+        sym = cache.get(k) if cache is not None else None
+        if sym is not None:
+            canon[k] = sym
+        elif k in _pending:
+            waiting[k] = _pending[k]
+        else:
+            _pending[k] = waiting[k] = loop.create_future()
+            new.append((i,j))
+    if new:
+        fresh: Dict[int,str] = {}
+        try:
+            fresh = await _ask_many(client, items, new)
+        finally:
+            for (i,j) in new:  # resolve dedupers; cancel them if the API call failed
+                k = pair_key(i,j)
+                fut = _pending.pop(k)
+                if k in fresh: fut.set_result(fresh[k])
+                else: fut.cancel()
+        if cache is not None:
+            cache.update(fresh)
+    for k, fut in waiting.items():
+        canon[k] = await fut
+    return {(i,j): oriented(canon[pair_key(i,j)], i, j) for (i,j) in idx_pairs}
+
+async def _ask_many(client: AsyncOpenAI, items: List[dict], idx_pairs: List[Tuple[int,int]]) -> Dict[int,str]:
+    """Ask the model about idx_pairs with up to DIFF_BATCH_SIZE comparisons per prompt, so the system
+       prompt is paid once per batch; batches that fail to parse fall back to one call per pair.
+       Each chunk goes to DIFF_ROUTER_MODEL first and only its low-confidence answers are re-asked
+       of DIFF_MODEL. Returns canonical symbols keyed by pair_key."""
+    def user_for(chunk):
+        if len(chunk) == 1:
+            (i,j), = chunk
+            return build_diff_user(items[i]["question"], items[i]["answer"], items[j]["question"], items[j]["answer"])
+        return build_diff_user_batch([(items[i]["question"], items[i]["answer"], items[j]["question"], items[j]["answer"]) for i,j in chunk])
+    async def ask(model: str, user: str, max_tokens: int, **extra):
+        async def _call():
+            return await limited_create(client,
+                model=model,
                 messages=[
                     {"role":"system","content":DIFF_SYSTEM_TEMPLATE},
                     {"role":"user","content":user},
                 ],
                 temperature=0.0,
-                max_tokens=4,
+                max_tokens=max_tokens,
+                **extra,
             )
-            return resp
-        r = with_backoff(_call)
-        symbol = r.choices[0].message.content.strip()
+        async with _sem:
+            r = await with_backoff_async(_call)
+        return r.choices[0]
+    async def do_pair(i,j):
+        symbol = ((await ask(DIFF_MODEL, user_for([(i,j)]), 4)).message.content or "").strip()
         symbol = symbol[:1] if symbol and symbol[0] in "<>=" else "="
         return ((i,j), symbol)
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS_DIFF) as ex:
-        futs = [ex.submit(do_pair, i,j) for (i,j) in idx_pairs]
-        for f in as_completed(futs):
-            pair, sym = f.result()
-            results[pair] = sym
-    # persist
-    cache_write(list(results.items()))
-    return results
+    async def do_batch(chunk):
+        if len(chunk) > 1:
+            choice = await ask(DIFF_MODEL, user_for(chunk), 2*len(chunk) + 2)
+            syms = parse_diff_batch(choice.message.content or "", len(chunk))
+            if syms is not None:
+                return list(zip(chunk, syms))
+        return await asyncio.gather(*[do_pair(i,j) for (i,j) in chunk])
+    async def do_routed(chunk):
+        """Cheap model with logprobs; keep answers whose symbol token has p >= DIFF_ROUTER_MIN_PROB."""
+        if not DIFF_ROUTER_MODEL:
+            return await do_batch(chunk)
+        choice = await ask(DIFF_ROUTER_MODEL, user_for(chunk), 2*len(chunk) + 2, logprobs=True, top_logprobs=3)
+        # One (symbol, probability) per symbol character, taken from the token that carries it
+        found = [(c, math.exp(t.logprob)) for t in (choice.logprobs.content if choice.logprobs else None) or [] for c in t.token if c in "<>="]
+        if len(found) != len(chunk):
+            sure, unsure = [], chunk
+        else:
+            sure = [(pair, sym) for pair, (sym, p) in zip(chunk, found) if p >= DIFF_ROUTER_MIN_PROB]
+            unsure = [pair for pair, (sym, p) in zip(chunk, found) if p < DIFF_ROUTER_MIN_PROB]
+        usage_stats["diff_router_accepted"] += len(sure)
+        usage_stats["diff_router_escalated"] += len(unsure)
+        return sure + (list(await do_batch(unsure)) if unsure else [])
+    # Items with identical text are one item to the model: pairs of such twins are '=' without asking,
+    # and pairs that differ only in which twin they use share one question (keyed by the reps' pair_key).
+    rep: Dict[Tuple[str,str], int] = {}
+    def rep_of(x: int) -> int:
+        return rep.setdefault((items[x]["question"], items[x]["answer"]), x)
+    out: Dict[int,str] = {}
+    groups: Dict[int, List[Tuple[int,int]]] = {}
+    for (i,j) in idx_pairs:
+        ri, rj = rep_of(i), rep_of(j)
+        if ri == rj:
+            out[pair_key(i,j)] = "="
+        else:
+            groups.setdefault(pair_key(ri,rj), []).append((i,j))
+    asked = [tuple(map(rep_of, members[0])) for members in groups.values()]
+    usage_stats["diff_deduped"] += len(idx_pairs) - len(asked)
+    chunks = [asked[b : b+DIFF_BATCH_SIZE] for b in range(0, len(asked), DIFF_BATCH_SIZE)]
+    for done in await asyncio.gather(*[do_routed(c) for c in chunks]):
+        for (ri,rj), sym in done:
+            canon = oriented(sym, ri, rj)
+            for (i,j) in groups[pair_key(ri,rj)]:
+                out[pair_key(i,j)] = oriented(oriented(canon, rep_of(i), rep_of(j)), i, j)
+    return out
+
+# ---- Absolute difficulty scores (coarse pre-sort) ----
+def item_id(items: List[dict], idx: int):
+    return items[idx].get("id", idx)
+
+def load_scores() -> Dict[Any, int]:
+    return {rec["id"]: rec["score"] for rec in read_framed(SCORE_CACHE) if "id" in rec and "score" in rec}
+
+async def score_item(client: AsyncOpenAI, item: dict) -> int:
+    """Ask for a 1–10 difficulty; unparseable replies and permanent request failures land in the middle bucket."""
+    async with _sem:
+        try:
+            text = await cached_completion(client, namespace="score",
+                model=SCORE_MODEL,
+                messages=[
+                    {"role":"system","content":SCORE_SYSTEM_TEMPLATE},
+                    {"role":"user","content":build_score_user(item["question"], item["answer"])},
+                ],
+                temperature=0.0,
+                max_tokens=3,
+            )
+        except PERMANENT_ERRORS + (CachedFailure,) as e:
+            usage_stats["score_failed"] += 1
+            print(f"Scoring failed, using 5: {e}")
+            text = ""
+    m = re.search(r"\d+", text)
+    return min(10, max(1, int(m.group()))) if m else 5
+
+async def score_items(client: AsyncOpenAI, items: List[dict]) -> List[int]:
+    """Score of every item (by index), asking only for ids missing from SCORE_CACHE and
+       checkpointing every SCORE_BATCH_SIZE items."""
+    scores = load_scores()
+    missing = [idx for idx in range(len(items)) if item_id(items, idx) not in scores]
+    for b in range(0, len(missing), SCORE_BATCH_SIZE):
+        chunk = missing[b : b+SCORE_BATCH_SIZE]
+        got = await asyncio.gather(*[score_item(client, items[idx]) for idx in chunk])
+        recs = [{"id": item_id(items, idx), "score": s} for idx, s in zip(chunk, got)]
+        append_framed(SCORE_CACHE, recs)
+        flush_jsonl(SCORE_CACHE)
+        scores.update((r["id"], r["score"]) for r in recs)
+    return [scores[item_id(items, idx)] for idx in range(len(items))]
 
 # ---- Merge with total preorder (groups) ----
-def merge_groups(client: OpenAI, items: List[dict], left: List[int], right: List[int], cache: Dict[str,str]) -> List[List[int]]:
-    """Left and right are lists of indices that may already be grouped by equal difficulty.
-       We merge into a list of equivalence groups (list of lists)."""
+def ensure_groups(xs):
     # Expand groups: we store as list[list[int]]; if flat, wrap
-    def ensure_groups(xs):
-        if len(xs) == 0: return []
-        if isinstance(xs[0], list): return xs # already grouped
-        return [[x] for x in xs]
+    if len(xs) == 0: return []
+    if isinstance(xs[0], list): return xs # already grouped
+    return [[x] for x in xs]
+
+class Wavefront:
+    """Collects the comparisons that concurrently running merges ask for within the same few
+       event-loop turns and resolves them with one compare_many call (one wave of batched prompts),
+       so merges across a layer, and across score buckets, share prompts."""
+    TURNS = 3  # loop turns to wait so every runnable merge gets to enqueue its next pair
+
+    def __init__(self, client: AsyncOpenAI, items: List[dict], cache: CompareCache):
+        self.client, self.items, self.cache = client, items, cache
+        self.queue: List[Tuple[Tuple[int,int], asyncio.Future]] = []
+        self.flusher: asyncio.Task | None = None
+        self.in_flight: set = set()  # strong refs; the loop only keeps weak ones to tasks
 
+    async def compare(self, i: int, j: int) -> str:
+        """Symbol for i vs j, answered from the cache when possible."""
+        sym = self.cache.get(pair_key(i,j))
+        if sym is not None:
+            return oriented(sym, i, j)
+        fut = asyncio.get_running_loop().create_future()
+        self.queue.append(((i,j), fut))
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self._flush())
+            self.in_flight.add(self.flusher)
+            self.flusher.add_done_callback(self.in_flight.discard)
+        return await fut
+
+    async def _flush(self):
+        for _ in range(self.TURNS):
+            await asyncio.sleep(0)
+        wave, self.queue, self.flusher = self.queue, [], None
+        try:
+            res = await compare_many(self.client, self.items, [p for p, _ in wave], self.cache)
+        except BaseException as e:
+            for _, fut in wave:
+                if not fut.done(): fut.set_exception(e)
+            return
+        for p, fut in wave:
+            if not fut.done(): fut.set_result(res[p])
+
+async def merge_groups(wave: Wavefront, left: List, right: List) -> List[List[int]]:
+    """Left and right are lists of indices that may already be grouped by equal difficulty.
+       We merge into a list of equivalence groups (list of lists)."""
     lg = ensure_groups(left)
     rg = ensure_groups(right)
 
@@ -93,14 +299,7 @@ def merge_groups(client: OpenAI, items: List[dict], left: List[int], right: List
     while li < len(lg) and ri < len(rg):
         Lgrp, Rgrp = lg[li], rg[ri]
         # Compare a representative pair (first elements)
-        i, j = Lgrp[0], Rgrp[0]
-        k = pair_key(i,j)
-        if k in cache:
-            sym = cache[k]
-        else:
-            res = compare_many(client, items, [(i,j)])
-            sym = res[(i,j)]
-            cache[k] = sym
+        sym = await wave.compare(Lgrp[0], Rgrp[0])
 
         if sym == "<":       # left easier -> goes earlier
             out.append(Lgrp)
@@ -119,50 +318,32 @@ def merge_groups(client: OpenAI, items: List[dict], left: List[int], right: List
         out.append(rg[ri]); ri += 1
     return out
 
-def tournament_sort(client: OpenAI, items: List[dict]) -> List[List[int]]:
+async def sort_bucket(wave: Wavefront, indices: List[int]) -> List[List[int]]:
+    """Order `indices` into equivalence groups with the pairwise tournament."""
+    # Bottom-up merge sort over runs; each run is a sorted list of equivalence groups, so group
+    # boundaries survive every layer and no extra pass is needed to rebuild them.
+    runs: List[List[List[int]]] = [[[x]] for x in indices]
+    while len(runs) > 1:
+        # every merge of a layer runs concurrently
+        merged = list(await asyncio.gather(*[merge_groups(wave, runs[i], runs[i+1]) for i in range(0, len(runs) - 1, 2)]))
+        if len(runs) % 2:
+            merged.append(runs[-1])
+        runs = merged
+    return runs[0] if runs else []
+
+async def tournament_sort(client: AsyncOpenAI, items: List[dict]) -> List[List[int]]:
     """Return list of equivalence groups (each group is a list of item indices).
-       Earlier groups are EASIER. Later groups are HARDER."""
-    n = len(items)
-    indices = list(range(n))
-
-    # Bottom-up merge sort in groups, enabling parallel compares at each merge
-    width = 1
-    cache = load_compare_cache()
-    while width < n:
-        new_groups: List[List[int]] = []
-        for i in range(0, n, 2*width):
-            left = indices[i : i+width]
-            right = indices[i+width : i+2*width]
-            if not right:
-                new_groups.extend([[x] for x in left])
-                continue
-            merged = merge_groups(client, items, left, right, cache)
-            # Flatten groups into indices for next layer, but we keep group boundaries by inserting markers
-            flat = list(itertools.chain.from_iterable(merged))
-            new_groups.extend(merged)
-        # After one full pass, rebuild indices from groups in order
-        indices = list(itertools.chain.from_iterable(new_groups))
-        width *= 2
-    # One pass produced groups aligned; convert indices back to grouped form using cached comparisons
-    # We already have groups in new_groups from the last iteration when n>1.
-    # Edge case: n==1
-    if n <= 1:
-        return [[0]] if n==1 else []
-    # Build groups again from final pass
-    # Since we lose boundaries after final flatten, compute groups by single left-to-right compare
-    groups: List[List[int]] = [[indices[0]]]
-    for k in range(1, len(indices)):
-        prev = groups[-1][0]
-        cur = indices[k]
-        key = pair_key(prev, cur)
-        sym = load_compare_cache().get(key)
-        if sym is None:
-            sym = compare_many(client, items, [(prev, cur)])[(prev, cur)]
-        if sym == "=":
-            groups[-1].append(cur)
-        else:
-            groups.append([cur])
-    return groups
+       Earlier groups are EASIER. Later groups are HARDER.
+       Items are bucketed by their 1–10 score first; the pairwise tournament only runs inside each
+       bucket, so it needs far fewer comparisons than sorting all n items pairwise."""
+    scores = await score_items(client, items)
+    buckets: Dict[int, List[int]] = {}
+    for idx, s in enumerate(scores):
+        buckets.setdefault(s, []).append(idx)
+    with CompareCache() as cache:
+        wave = Wavefront(client, items, cache)
+        sorted_buckets = await asyncio.gather(*[sort_bucket(wave, buckets[s]) for s in sorted(buckets)])
+    return [grp for groups in sorted_buckets for grp in groups]
 
 def assign_ranks(groups: List[List[int]]) -> Dict[int, int]:
     """Lower rank number = easier. Equal items share same rank."""
@@ -172,28 +353,31 @@ def assign_ranks(groups: List[List[int]]) -> Dict[int, int]:
             ranks[idx] = r
     return ranks
 
+async def rank_items(items: List[dict]) -> List[List[int]]:
+    # The async client's connection pool is bound to the running loop, so build it in here.
+    client = get_async_client()
+    return await tournament_sort(client, items)
+
 def main():
-    client = get_client()
     items = load_items()  # load all tagged or raw
-    groups = tournament_sort(client, items)
+    groups = asyncio.run(rank_items(items))
+    print(f"OpenAI usage: {usage_summary()}")
+    routed = usage_stats["diff_router_accepted"] + usage_stats["diff_router_escalated"]
+    if routed:
+        print(f"Comparisons escalated from {DIFF_ROUTER_MODEL} to {DIFF_MODEL}: "
+              f"{usage_stats['diff_router_escalated']}/{routed} ({100.0 * usage_stats['diff_router_escalated'] / routed:.1f}%)")
     ranks = assign_ranks(groups)
 
     # Write final combined JSONL (question, answer, skill_tags?, difficulty_rank)
-    out_recs = []
-    for idx, rec in enumerate(items):
-        out = {
+    for b in range(0, len(items), 10_000):
+        append_jsonl(FINAL_PATH, [{
             "id": rec.get("id", idx),
             "question": rec["question"],
             "answer": rec["answer"],
             "skill_tags": rec.get("skill_tags", []),
             "difficulty_rank": int(ranks[idx]),
-        }
-        out_recs.append(out)
-        if len(out_recs) >= 1000:
-            append_jsonl(FINAL_PATH, out_recs)
-            out_recs.clear()
-    if out_recs:
-        append_jsonl(FINAL_PATH, out_recs)
+        } for idx, rec in enumerate(items[b : b+10_000], start=b)])
+    flush_jsonl(FINAL_PATH)
     print(f"Wrote ranks to {FINAL_PATH}")
 
 if __name__ == "__main__":
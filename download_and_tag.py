@@ -4,16 +4,17 @@ Download Microsoft Orca Math Word Problems 200k and skill‑tag each item with O
 Saves streaming JSONL checkpoints so you can resume anytime.
 
 usage:
-  OPENAI_API_KEY=... python download_and_tag.py
+  OPENAI_API_KEY=... python download_and_tag.py           # real-time chat endpoint
+  OPENAI_API_KEY=... python download_and_tag.py --batch   # Batch API: 50% cheaper, results within 24h
 """
 from __future__ import annotations
-import os, re, json, math, random
+import os, re, json, math, random, asyncio, argparse, time, threading, concurrent.futures
 from typing import List, Tuple
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from datasets import load_dataset
-from openai import OpenAI
+from openai import AsyncOpenAI
 from config import *
-from utils import append_jsonl, read_jsonl, count_jsonl, get_client, with_backoff, SKILL_SYSTEM_TEMPLATE, build_skill_user
+from semantic_cache import get_semantic_cache
+from utils import append_jsonl, flush_jsonl, read_jsonl, count_jsonl, get_client, get_async_client, cached_completion, PERMANENT_ERRORS, CachedFailure, with_backoff, usage_stats, usage_summary, build_skill_system, build_skill_user
 
 def load_orca_stream() -> List[dict]:
     ds = load_dataset("microsoft/orca-math-word-problems-200k", split="train", streaming=True)
@@ -28,7 +29,7 @@ def previously_tagged_ids() -> set[int]:
             done.add(rec["id"])
     return done
 
-def select_examples(max_examples: int = 12) -> List[Tuple[str,str,List[str]]]:
+def select_examples(max_examples: int = SKILL_EXAMPLES) -> List[Tuple[str,str,List[str]]]:
     """Read already-tagged records to use as few-shot examples in prompt."""
     out = []
     for rec in read_jsonl(TAGGED_PATH):
@@ -39,52 +40,241 @@ def select_examples(max_examples: int = 12) -> List[Tuple[str,str,List[str]]]:
             break
     return out
 
-def tag_batch(client: OpenAI, items: List[dict], examples: List[Tuple[str,str,List[str]]]):
-    messages = []
-    # We'll call API per item (parallel by ThreadPool), not batch in a single request, to simplify retries.
+def parse_tags(text: str) -> List[str]:
+    # Parse tags (comma-separated)
+    return [t.strip() for t in re.split(r"[;,]", text.strip()) if t.strip()]
+
+def skill_request_body(it: dict, system: str) -> dict:
+    return {
+        "model": SKILL_MODEL,
+        "messages": [
+            {"role":"system","content":system},
+            {"role":"user","content":build_skill_user(it["question"], it["answer"])},
+        ],
+        "temperature": 0.2,
+        "max_tokens": 256,
+    }
+
+# Shared by every tag_batch in flight, so SKILL_TAG_WORKERS consumers still cap at MAX_WORKERS_SKILL calls.
+_sem = asyncio.Semaphore(MAX_WORKERS_SKILL)
+
+async def tag_batch(client: AsyncOpenAI, items: List[dict], system: str):
+    """`system` comes from build_skill_system(examples) and should stay the same across batches so
+       the prompt prefix (instructions + few-shot examples) hits OpenAI's prompt cache."""
+    # We'll call API per item (concurrent coroutines), not batch in a single request, to simplify retries.
+    async def do_one(it):
+        async with _sem:
+            try:
+                text = await cached_completion(client, namespace="skill", **skill_request_body(it, system))
+            except PERMANENT_ERRORS + (CachedFailure,) as e:
+                # Left untagged, as in the Batch API path; the next run tries it again
+                usage_stats["skill_failed"] += 1
+                print(f"Item {it['id']} not tagged: {e}")
+                return None
+        return {**it, "skill_tags": parse_tags(text)}
+    sem_cache = get_semantic_cache()
+    if sem_cache is None:
+        out_records = await asyncio.gather(*[do_one(it) for it in items])
+    else:
+        # Near-duplicates of already-tagged items reuse their tags; only the rest go to the LLM
+        xs = await asyncio.to_thread(sem_cache.embed, items)
+        hits = sem_cache.lookup(xs)
+        misses = [k for k, tags in enumerate(hits) if tags is None]
+        fresh = await asyncio.gather(*[do_one(items[k]) for k in misses])
+        tagged = [(k, rec) for k, rec in zip(misses, fresh) if rec is not None]
+        if tagged:
+            sem_cache.add(xs[[k for k, _ in tagged]], [rec["skill_tags"] for _, rec in tagged])
+        usage_stats["semantic_cache_hits"] += len(items) - len(misses)
+        out_records = [{**it, "skill_tags": tags} if tags is not None else None for it, tags in zip(items, hits)]
+        for k, rec in zip(misses, fresh):
+            out_records[k] = rec
+    append_jsonl(TAGGED_PATH, [rec for rec in out_records if rec is not None])
+
+async def run():
+    client = get_async_client()
+    done = previously_tagged_ids()
+    loop = asyncio.get_running_loop()
+    # Bounded: the stream thread blocks once consumers are 4 batches behind.
+    queue: asyncio.Queue = asyncio.Queue(maxsize=4 * SKILL_BATCH_SIZE)
+    sem_cache = get_semantic_cache()
+    if sem_cache is not None:
+        # Only records tagged since the index was last saved need embedding
+        total = count_jsonl(TAGGED_PATH)
+        covered = sem_cache.load(SEMANTIC_CACHE_INDEX, total)
+        if await asyncio.to_thread(sem_cache.seed, read_jsonl(TAGGED_PATH), covered):
+            await asyncio.to_thread(sem_cache.save, SEMANTIC_CACHE_INDEX, total)
+    # Select the few-shot examples once, not per batch: a byte-identical system prefix is cacheable.
+    examples = select_examples()
+    state = {"examples": examples, "system": build_skill_system(examples), "batches": 0, "synced": time.monotonic()}
+
+    # Set when run() exits for any reason; a producer blocked on a full queue whose consumers died sees it and stops.
+    stop = threading.Event()
+
+    def put(rec) -> bool:
+        fut = asyncio.run_coroutine_threadsafe(queue.put(rec), loop)
+        while True:
+            try:
+                fut.result(timeout=1.0)
+                return True
+            except concurrent.futures.TimeoutError:
+                if stop.is_set():
+                    fut.cancel()
+                    return False
+
+    def produce():
+        # HF streaming is blocking I/O, so it runs in a worker thread and hands records to the loop.
+        try:
+            for rec in load_orca_stream():
+                if rec["id"] not in done and not put(rec):
+                    return
+        finally:
+            if not stop.is_set():
+                put(None)
+
+    async def consume():
+        while True:
+            buf = []
+            while len(buf) < SKILL_BATCH_SIZE:
+                rec = await queue.get()
+                if rec is None:
+                    await queue.put(None)  # leave the end marker for the other consumers
+                    break
+                buf.append(rec)
+            if buf:
+                await tag_batch(client, buf, state["system"])
+                state["batches"] += 1
+                if time.monotonic() - state["synced"] >= JSONL_FSYNC_SECONDS:
+                    flush_jsonl(TAGGED_PATH)  # one fsync covers every batch since the last one
+                    state["synced"] = time.monotonic()
+                # A fresh run has no examples yet, so keep picking them up until the set is full;
+                # after that the prefix only changes every SKILL_EXAMPLES_REFRESH batches.
+                if len(state["examples"]) < SKILL_EXAMPLES or (SKILL_EXAMPLES_REFRESH and state["batches"] % SKILL_EXAMPLES_REFRESH == 0):
+                    state["examples"] = select_examples()
+                    state["system"] = build_skill_system(state["examples"])
+            if len(buf) < SKILL_BATCH_SIZE:
+                return
+
+    workers = [asyncio.create_task(consume()) for _ in range(SKILL_TAG_WORKERS)]
+    try:
+        await asyncio.gather(asyncio.to_thread(produce), *workers)
+    finally:
+        stop.set()
+        for w in workers:  # one failed consumer stops the rest instead of leaving them waiting on the queue
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        flush_jsonl(TAGGED_PATH)
+        if sem_cache is not None:
+            sem_cache.save(SEMANTIC_CACHE_INDEX, count_jsonl(TAGGED_PATH))
+
+# ---- Batch API path ----
+def write_batch_files(rows: List[dict], system: str):
+    """Yield request files for the Batch API, each within BATCH_API_MAX_REQUESTS lines and BATCH_API_MAX_BYTES.
+       Every line repeats the system prompt and its few-shot examples, so the byte cap binds first."""
+    f, part, n, size = None, 0, 0, 0
+    try:
+        for it in rows:
+            line = (json.dumps({"custom_id": str(it["id"]), "method": "POST", "url": "/v1/chat/completions",
+                                "body": skill_request_body(it, system)}, ensure_ascii=False) + "\n").encode("utf-8")
+            if f is not None and (n >= BATCH_API_MAX_REQUESTS or size + len(line) > BATCH_API_MAX_BYTES):
+                f.close()
+                yield f.name
+                f = None
+            if f is None:
+                f = open(os.path.join(DATA_DIR, f"skill_batch_requests_{part}.jsonl"), "wb")
+                part += 1
+                n = size = 0
+            f.write(line)
+            n += 1
+            size += len(line)
+        if f is not None:
+            f.close()  # complete on disk before upload
+            yield f.name
+    finally:
+        if f is not None:
+            f.close()
+
+def pending_batch_ids() -> List[str]:
+    """Batches submitted (per BATCH_API_LOG) but not yet collected, e.g. by an interrupted run."""
+    submitted, collected = [], set()
+    for rec in read_jsonl(BATCH_API_LOG):
+        if rec.get("collected"):
+            collected.add(rec["batch_id"])
+        else:
+            submitted.append(rec["batch_id"])
+    return [b for b in submitted if b not in collected]
+
+def submit_skill_batch(client, path: str) -> str:
+    """Upload one request file (then delete it) and start a 24h batch. Returns the batch id, recorded in BATCH_API_LOG."""
+    def _upload():
+        with open(path, "rb") as f:  # reopened per attempt, so a retry sends the whole file again
+            return client.files.create(file=f, purpose="batch")
+    upload = with_backoff(_upload)
+    os.remove(path)  # uploaded; the file repeats the system prompt on every line, so don't keep it around
+    batch = with_backoff(lambda: client.batches.create(
+        input_file_id=upload.id, endpoint="/v1/chat/completions", completion_window="24h"))
+    append_jsonl(BATCH_API_LOG, [{"batch_id": batch.id, "input": os.path.basename(path)}])
+    flush_jsonl(BATCH_API_LOG)
+    print(f"Submitted batch {batch.id} ({path})")
+    return batch.id
+
+def collect_skill_batch(client, batch_id: str, rows_by_id: dict) -> int:
+    """Poll until the batch finishes, then append its successful rows to TAGGED_PATH. Returns rows written."""
+    while True:
+        batch = with_backoff(lambda: client.batches.retrieve(batch_id))
+        if batch.status in ("completed", "failed", "expired", "cancelled"):
+            break
+        time.sleep(BATCH_POLL_SECONDS)
     out_records = []
-    def do_one(it):
-        q = it["question"]; a = it["answer"]
-        user = build_skill_user(q, a, examples)
-        def _call():
-            resp = client.chat.completions.create(
-                model=SKILL_MODEL,
-                messages=[
-                    {"role":"system","content":SKILL_SYSTEM_TEMPLATE},
-                    {"role":"user","content":user},
-                ],
-                temperature=0.2,
-                max_tokens=256,
-            )
-            return resp
-        resp = with_backoff(_call)
-        text = resp.choices[0].message.content.strip()
-        # Parse tags (comma-separated)
-        tags = [t.strip() for t in re.split(r"[;,]", text) if t.strip()]
-        return {**it, "skill_tags": tags}
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS_SKILL) as ex:
-        futs = [ex.submit(do_one, it) for it in items]
-        for f in as_completed(futs):
-            out_records.append(f.result())
+    if batch.output_file_id:
+        content = with_backoff(lambda: client.files.content(batch.output_file_id)).text
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            res = json.loads(line)
+            resp = res.get("response") or {}
+            if res.get("error") or resp.get("status_code") != 200:
+                continue  # left untagged; the next run picks it up again
+            it = rows_by_id.get(int(res["custom_id"]))
+            if it is None:
+                continue
+            text = resp["body"]["choices"][0]["message"]["content"] or ""
+            out_records.append({**it, "skill_tags": parse_tags(text)})
     append_jsonl(TAGGED_PATH, out_records)
+    flush_jsonl(TAGGED_PATH)
+    append_jsonl(BATCH_API_LOG, [{"batch_id": batch_id, "collected": True}])
+    flush_jsonl(BATCH_API_LOG)
+    if not batch.output_file_id:
+        print(f"Batch {batch_id} ended as {batch.status} with no output")
+    else:
+        print(f"Batch {batch_id} {batch.status}: {len(out_records)} tagged")
+    return len(out_records)
 
-def main():
-    os.makedirs(DATA_DIR, exist_ok=True)
+def run_batch_api():
     client = get_client()
     done = previously_tagged_ids()
-    buf = []
-    stream = load_orca_stream()
-    for rec in stream:
-        if rec["id"] in done: 
-            continue
-        buf.append(rec)
-        if len(buf) >= SKILL_BATCH_SIZE:
-            examples = select_examples()
-            tag_batch(client, buf, examples)
-            buf = []
-    if buf:
-        examples = select_examples()
-        tag_batch(client, buf, examples)
+    rows_by_id = {rec["id"]: rec for rec in load_orca_stream() if rec["id"] not in done}
+    # Batches an interrupted run left behind are collected first, so their rows aren't paid for twice
+    pending = pending_batch_ids()
+    for batch_id in pending:
+        collect_skill_batch(client, batch_id, rows_by_id)
+    if pending:
+        done = previously_tagged_ids()
+    system = build_skill_system(select_examples())
+    rows = [it for i, it in rows_by_id.items() if i not in done]
+    batch_ids = [submit_skill_batch(client, path) for path in write_batch_files(rows, system)]
+    for batch_id in batch_ids:
+        collect_skill_batch(client, batch_id, rows_by_id)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--batch", action="store_true", help="tag through the OpenAI Batch API instead of the real-time endpoint")
+    args = ap.parse_args()
+    os.makedirs(DATA_DIR, exist_ok=True)
+    if args.batch:
+        run_batch_api()
+    else:
+        asyncio.run(run())
+        print(f"OpenAI usage: {usage_summary()}")
     print(f"Tagged written to {TAGGED_PATH} (count so far: {count_jsonl(TAGGED_PATH)})")
 
 if __name__ == "__main__":
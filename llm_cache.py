@@ -0,0 +1,73 @@
+"""
+Persistent response cache for LLM calls: response text keyed by a hash of (namespace, model, system, user)
+(blake3 when installed, else sha256).
+SQLite in WAL mode, so lookups are local point queries and concurrent runs can share the file.
+Also a short-lived negative cache: requests that failed permanently (e.g. a 400) are remembered for
+LLM_NEGATIVE_TTL seconds so identical requests fail without another API trip.
+Set LLM_CACHE="" to disable.
+"""
+from __future__ import annotations
+import json, hashlib, sqlite3, threading, time
+from typing import Optional
+
+from config import LLM_CACHE
+try:
+    from blake3 import blake3 as _hasher  # SIMD tree hash; several times faster than sha256 on long prompts
+except ImportError:
+    _hasher = hashlib.sha256
+
+_db: sqlite3.Connection | None = None
+_lock = threading.Lock()
+
+def _conn() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        with _lock:
+            if _db is None:
+                db = sqlite3.connect(LLM_CACHE, check_same_thread=False, isolation_level=None)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+                db.execute("CREATE TABLE IF NOT EXISTS llm(k TEXT PRIMARY KEY, v TEXT) WITHOUT ROWID")
+                db.execute("CREATE TABLE IF NOT EXISTS neg(k TEXT PRIMARY KEY, err TEXT, until REAL) WITHOUT ROWID")
+                _db = db
+    return _db
+
+def enabled() -> bool:
+    return bool(LLM_CACHE)
+
+def request_key(model: str, system: str, user: str, namespace: str = "", options: dict | None = None) -> str:
+    """`options` (max_tokens, temperature, ...) only when given, so existing response keys stay valid."""
+    h = _hasher()
+    for part in (namespace, model, system, user):
+        h.update(part.encode("utf-8"))
+        h.update(b"\x1f")
+    if options:
+        h.update(json.dumps(options, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+def get(key: str) -> Optional[str]:
+    if not enabled(): return None
+    db = _conn()
+    with _lock:
+        row = db.execute("SELECT v FROM llm WHERE k=?", (key,)).fetchone()
+    return row[0] if row else None
+
+def put(key: str, val: str):
+    if not enabled(): return
+    db = _conn()
+    with _lock:
+        db.execute("INSERT OR REPLACE INTO llm(k, v) VALUES (?, ?)", (key, val))
+
+def get_failure(key: str) -> Optional[str]:
+    """Error message of a permanent failure for `key` that hasn't expired yet."""
+    if not enabled(): return None
+    db = _conn()
+    with _lock:
+        row = db.execute("SELECT err FROM neg WHERE k=? AND until>?", (key, time.time())).fetchone()
+    return row[0] if row else None
+
+def put_failure(key: str, err: str, ttl: float):
+    if not enabled() or ttl <= 0: return
+    db = _conn()
+    with _lock:
+        db.execute("INSERT OR REPLACE INTO neg(k, err, until) VALUES (?, ?, ?)", (key, err, time.time() + ttl))
@@ -0,0 +1,110 @@
+"""
+A/B the full vs compact system prompts (utils.SYSTEM_TEMPLATES) on a sample of tagged items.
+- diff: the same random pairs judged under each variant; compares the '<'/'>'/'=' distribution.
+- skill: the same items tagged under each variant (same frozen examples); compares tag frequencies.
+A chi-square homogeneity test on each table; a large p-value means no detectable shift, so the
+shorter prompt can be adopted with PROMPT_VARIANT=compact.
+
+usage:
+  OPENAI_API_KEY=... python prompt_ab.py [--n 500] [--task diff|skill|both]
+"""
+from __future__ import annotations
+import argparse, asyncio, math, random
+from collections import Counter
+from typing import List, Tuple
+
+from config import *
+from utils import (read_jsonl, get_async_client, limited_create, with_backoff_async, map_bounded, usage_summary,
+                   SYSTEM_TEMPLATES, build_diff_user, build_skill_system, build_skill_user)
+from download_and_tag import select_examples, parse_tags
+
+# ---- Statistics ----
+def chi2_sf(x: float, df: int) -> float:
+    """P(X >= x) for X ~ chi-square(df), via the series for the regularized lower incomplete gamma."""
+    if x <= 0: return 1.0
+    s, z = df / 2.0, x / 2.0
+    term = total = 1.0 / s
+    n = 1
+    while term > total * 1e-12 and n < 10_000:
+        term *= z / (s + n)
+        total += term
+        n += 1
+    return max(0.0, 1.0 - math.exp(s * math.log(z) - z - math.lgamma(s)) * total)
+
+def chi2_homogeneity(a: Counter, b: Counter) -> Tuple[float, int, float]:
+    """Chi-square test that two count vectors over the same categories share one distribution."""
+    cats = [c for c in set(a) | set(b) if a[c] + b[c] > 0]
+    na, nb = sum(a[c] for c in cats), sum(b[c] for c in cats)
+    stat = 0.0
+    for c in cats:
+        col = a[c] + b[c]
+        for obs, row in ((a[c], na), (b[c], nb)):
+            exp = row * col / (na + nb)
+            stat += (obs - exp) ** 2 / exp
+    df = max(1, len(cats) - 1)
+    return stat, df, chi2_sf(stat, df)
+
+# ---- Runs ----
+async def ask(client, model: str, system: str, user: str, max_tokens: int, temperature: float) -> str:
+    async def _call():
+        return await limited_create(client,
+            model=model,
+            messages=[{"role":"system","content":system}, {"role":"user","content":user}],
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+    r = await with_backoff_async(_call)
+    return (r.choices[0].message.content or "").strip()
+
+async def diff_run(client, items: List[dict], pairs: List[Tuple[int,int]], system: str) -> Counter:
+    async def one(i, j):
+        text = await ask(client, DIFF_MODEL, system, build_diff_user(items[i]["question"], items[i]["answer"], items[j]["question"], items[j]["answer"]), 4, 0.0)
+        return text[:1] if text and text[0] in "<>=" else "="
+    return Counter(await map_bounded((one(i, j) for i, j in pairs), MAX_WORKERS_DIFF))
+
+async def skill_run(client, items: List[dict], system: str, top: int = 30) -> Counter:
+    async def one(it):
+        return parse_tags(await ask(client, SKILL_MODEL, system, build_skill_user(it["question"], it["answer"]), 256, 0.2))
+    counts = Counter(t.lower() for tags in await map_bounded((one(it) for it in items), MAX_WORKERS_SKILL) for t in tags)
+    # Keep the table dense enough for the test: top tags by count, the long tail pooled.
+    head = Counter(dict(counts.most_common(top)))
+    head["(other)"] = sum(counts.values()) - sum(head.values())
+    return head
+
+def report(task: str, full: Counter, compact: Counter):
+    stat, df, p = chi2_homogeneity(full, compact)
+    verdict = "no detectable shift" if p >= 0.05 else "distributions differ"
+    print(f"[{task}] full={dict(full.most_common(8))}")
+    print(f"[{task}] compact={dict(compact.most_common(8))}")
+    print(f"[{task}] chi2={stat:.2f} df={df} p={p:.3f} -> {verdict}")
+
+async def run(n: int, task: str):
+    client = get_async_client()
+    items = [rec for rec in read_jsonl(TAGGED_PATH)]
+    if not items:
+        raise SystemExit("No tagged data found. Run download_and_tag.py first.")
+    rnd = random.Random(0)
+    sample = rnd.sample(items, min(n, len(items)))
+    if task in ("diff", "both"):
+        if len(sample) < 2:
+            print("[diff] skipped: needs at least 2 tagged items")
+        else:
+            pairs = [tuple(rnd.sample(range(len(sample)), 2)) for _ in range(n)]
+            full, compact = [await diff_run(client, sample, pairs, SYSTEM_TEMPLATES[v][1]) for v in ("full", "compact")]
+            report("diff", full, compact)
+    if task in ("skill", "both"):
+        sample_questions = {rec["question"] for rec in sample}
+        examples = [e for e in select_examples() if e[0] not in sample_questions]  # don't leak answers
+        full, compact = [await skill_run(client, sample, build_skill_system(examples, SYSTEM_TEMPLATES[v][0])) for v in ("full", "compact")]
+        report("skill", full, compact)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--n", type=int, default=500, help="sample size (items, and pairs for diff)")
+    ap.add_argument("--task", choices=("diff", "skill", "both"), default="both")
+    args = ap.parse_args()
+    asyncio.run(run(args.n, args.task))
+    print(f"OpenAI usage: {usage_summary()}")
+
+if __name__ == "__main__":
+    main()
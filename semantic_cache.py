@@ -0,0 +1,100 @@
+"""
+Near-duplicate cache for skill tags: an item whose (question, answer) embedding has cosine similarity
+>= SEMANTIC_CACHE_THRESHOLD with an already-tagged item reuses that item's tags instead of calling the LLM.
+HNSW index (faiss) over normalized MiniLM embeddings (sentence-transformers), so inner product = cosine.
+Saved to SEMANTIC_CACHE_INDEX (+ a .json sidecar with the tags) so a resume only embeds newly tagged records.
+
+Optional; enable with SEMANTIC_CACHE=1 after:
+  pip install faiss-cpu sentence-transformers
+"""
+from __future__ import annotations
+import os, json, itertools, threading
+from typing import List, Optional, Iterable
+
+from config import SEMANTIC_CACHE, SEMANTIC_CACHE_MODEL, SEMANTIC_CACHE_THRESHOLD
+from utils import Lazy
+
+class SemanticCache:
+    def __init__(self, model_name: str = SEMANTIC_CACHE_MODEL, threshold: float = SEMANTIC_CACHE_THRESHOLD, m: int = 32):
+        import faiss
+        from sentence_transformers import SentenceTransformer
+        self.model_name = model_name
+        self.model = SentenceTransformer(model_name)
+        dim = self.model.get_sentence_embedding_dimension()  # 384 for MiniLM
+        self.index = faiss.IndexHNSWFlat(dim, m, faiss.METRIC_INNER_PRODUCT)
+        self.tags: List[List[str]] = []  # parallel to index ids
+        self.threshold = threshold
+        self.lock = threading.Lock()  # faiss adds aren't safe against concurrent searches
+
+    def embed(self, items: List[dict]):
+        """float32 (n, dim) unit vectors; CPU-bound, so call it off the event loop."""
+        texts = [f"{it['question']}\n{it['answer']}" for it in items]
+        return self.model.encode(texts, batch_size=64, normalize_embeddings=True, convert_to_numpy=True).astype("float32")
+
+    def lookup(self, xq) -> List[Optional[List[str]]]:
+        """Tags of the nearest cached item for each row of xq, or None below the threshold."""
+        with self.lock:
+            if self.index.ntotal == 0:
+                return [None] * len(xq)
+            D, I = self.index.search(xq, 1)
+            return [self.tags[i] if i >= 0 and d >= self.threshold else None for d, i in zip(D[:, 0], I[:, 0])]
+
+    def add(self, xs, tags: List[List[str]]):
+        with self.lock:
+            self.index.add(xs)
+            self.tags.extend(tags)
+
+    def seed(self, recs: Iterable[dict], skip: int = 0, chunk: int = 10_000) -> int:
+        """Index already-tagged records (e.g. TAGGED_PATH on resume) after the first `skip`,
+           which a loaded index already covers. Returns how many records were read."""
+        buf: List[dict] = []
+        n = 0
+        for rec in itertools.islice(recs, skip, None):
+            n += 1
+            if rec.get("skill_tags"):
+                buf.append(rec)
+            if len(buf) >= chunk:
+                self.add(self.embed(buf), [r["skill_tags"] for r in buf]); buf = []
+        if buf:
+            self.add(self.embed(buf), [r["skill_tags"] for r in buf])
+        return n
+
+    def save(self, path: str, records: int):
+        """Write the index to `path` and its tags to `path`.json. `records` is how many TAGGED_PATH
+           lines it covers, so the next run embeds only the ones after them."""
+        import faiss
+        with self.lock:
+            faiss.write_index(self.index, path + ".tmp")
+            meta = {"model": self.model_name, "records": records, "ntotal": self.index.ntotal, "tags": self.tags}
+        with open(path + ".json.tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(path + ".tmp", path)
+        os.replace(path + ".json.tmp", path + ".json")
+
+    def load(self, path: str, available: int) -> int:
+        """Adopt a saved index; returns the TAGGED_PATH records it covers (0 if missing or stale).
+           `available` is the current record count; a saved index covering more belongs to another file."""
+        import faiss
+        try:
+            with open(path + ".json", encoding="utf-8") as f:
+                meta = json.load(f)
+            index = faiss.read_index(path)
+        except (OSError, ValueError, RuntimeError):
+            return 0
+        # Both files are replaced separately; a crash in between leaves them out of step
+        if meta.get("model") != self.model_name or meta.get("records", 0) > available or index.ntotal != meta.get("ntotal") or len(meta["tags"]) != index.ntotal:
+            return 0
+        with self.lock:
+            self.index, self.tags = index, meta["tags"]
+        return meta["records"]
+
+@Lazy
+def get_semantic_cache() -> SemanticCache | None:
+    """Shared SemanticCache, or None when SEMANTIC_CACHE is off or its dependencies are missing."""
+    if not SEMANTIC_CACHE:
+        return None
+    try:
+        return SemanticCache()
+    except ImportError as e:
+        print(f"Semantic cache disabled: {e} (pip install faiss-cpu sentence-transformers)")
+        return None
@@ -1,17 +1,45 @@
 import os
+import re
+import json
+import hashlib
+try:
+    from blake3 import blake3 as _hasher
+except ImportError:
+    _hasher = hashlib.sha256
+import logging
 import httpx
+from contextlib import asynccontextmanager
+from cachetools import TTLCache
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 load_dotenv()
 APP_ID = os.getenv("MATHPIX_APP_ID", "")
 APP_KEY = os.getenv("MATHPIX_APP_KEY", "")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 
-app = FastAPI(title="OrcaMath API - Recognition & Validation")
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Process-wide clients so requests reuse pooled (HTTP/2) connections instead of a new TLS handshake each."""
+    app.state.http = httpx.AsyncClient(
+        timeout=30,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=100),
+    )
+    app.state.openai = AsyncOpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        if app.state.openai is not None:
+            await app.state.openai.close()
+
+app = FastAPI(title="OrcaMath API - Recognition & Validation", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -33,11 +61,19 @@ async def health_check():
         "version": "1.0.0"
     }
 
-# Initialize OpenAI client
-def get_openai_client():
-    if not OPENAI_API_KEY:
+# Responses for repeated (question, steps) submissions, e.g. re-submits and UI polling
+validation_cache: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+final_check_cache: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+
+def cache_key(*parts: str) -> str:
+    """Stable hash of the request fields that determine the model's answer."""
+    return _hasher("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+# Shared AsyncOpenAI client (created in lifespan)
+def get_openai_client() -> AsyncOpenAI:
+    if app.state.openai is None:
         raise ValueError("OPENAI_API_KEY not set")
-    return OpenAI(api_key=OPENAI_API_KEY)
+    return app.state.openai
 
 # Pydantic models for mathpix
 class Ink(BaseModel):
@@ -115,29 +151,27 @@ async def recognize(ink: Ink):
     src = f"data:image/png;base64,{ink.image_base64}"
     payload = {"src": src, "formats": ["text"], "data_options": {"include_asciimath": True}}
     headers = {"Content-Type": "application/json", "app_id": APP_ID, "app_key": APP_KEY}
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.post("https://api.mathpix.com/v3/text", json=payload, headers=headers)
-        resp.raise_for_status()
-        data = resp.json()
+    resp = await app.state.http.post("https://api.mathpix.com/v3/text", json=payload, headers=headers)
+    resp.raise_for_status()
+    data = resp.json()
     return {"text": (data.get("text") or "").strip(), "raw": data}
 
+# Simple "X op Y = Z" steps that can be verified without the model. Compiled once and matched
+# against the whole step: a partial match inside e.g. "32.76 - 1 * 17 = 15.76" would misjudge it.
+ARITHMETIC_PATTERNS = [
+    (re.compile(r'(\d+\.?\d*)\s*[/÷]\s*(\d+\.?\d*)\s*=\s*(\d+\.?\d*)'), '/', lambda a, b: a / b if b != 0 else None),
+    (re.compile(r'(\d+\.?\d*)\s*\*\s*(\d+\.?\d*)\s*=\s*(\d+\.?\d*)'), '*', lambda a, b: a * b),
+    (re.compile(r'(\d+\.?\d*)\s*\+\s*(\d+\.?\d*)\s*=\s*(\d+\.?\d*)'), '+', lambda a, b: a + b),
+    (re.compile(r'(\d+\.?\d*)\s*-\s*(\d+\.?\d*)\s*=\s*(\d+\.?\d*)'), '-', lambda a, b: a - b),
+]
+
 def check_arithmetic(step: str) -> tuple[bool | None, str | None]:
-    """Check if a step contains simple arithmetic that we can verify directly."""
-    import re
-    
+    """Check if a step is simple arithmetic that we can verify directly."""
     # Remove LaTeX delimiters
     step_clean = step.replace('\\(', '').replace('\\)', '').replace('$', '').strip()
     
-    # Match patterns like "X / Y = Z" or "X + Y = Z" etc.
-    patterns = [
-        (r'(\d+\.?\d*)\s*[/÷]\s*(\d+\.?\d*)\s*=\s*(\d+\.?\d*)', '/', lambda a, b: a / b if b != 0 else None),
-        (r'(\d+\.?\d*)\s*\*\s*(\d+\.?\d*)\s*=\s*(\d+\.?\d*)', '*', lambda a, b: a * b),
-        (r'(\d+\.?\d*)\s*\+\s*(\d+\.?\d*)\s*=\s*(\d+\.?\d*)', '+', lambda a, b: a + b),
-        (r'(\d+\.?\d*)\s*-\s*(\d+\.?\d*)\s*=\s*(\d+\.?\d*)', '-', lambda a, b: a - b),
-    ]
-    
-    for pattern, op_symbol, operation in patterns:
-        match = re.search(pattern, step_clean)
+    for pattern, op_symbol, operation in ARITHMETIC_PATTERNS:
+        match = pattern.fullmatch(step_clean)
         if match:
             try:
                 left = float(match.group(1))
@@ -148,11 +182,20 @@ def check_arithmetic(step: str) -> tuple[bool | None, str | None]:
                 if expected is None:
                     continue
                 
-                # Allow small floating point errors
-                if abs(expected - result) < 0.01:
-                    return True, f"Perfect! {left} {op_symbol} {right} = {result} is absolutely correct!"
-                else:
-                    return False, f"Check your calculation: {left} {op_symbol} {right} should equal {expected:.2f}, not {result}"
+                # Judge at the precision the student wrote: "100 / 7 = 14.3" is right to one decimal
+                written = match.group(3)
+                decimals = len(written.split('.', 1)[1]) if '.' in written else 0
+                # Feedback quotes the numbers as the student wrote them ("3 * 2", not "3.0 * 2.0")
+                a, b = match.group(1), match.group(2)
+                exact = f"{expected:.{max(decimals, 2)}f}".rstrip('0').rstrip('.')
+                if abs(expected - result) < 1e-9:
+                    return True, f"Perfect! {a} {op_symbol} {b} = {written} is absolutely correct!"
+                if decimals == 0 and expected != int(expected):
+                    return None, None  # "10 / 3 = 3" may be rounding or a quotient with remainder; ask the model
+                if abs(expected - result) <= 0.5 * 10 ** -decimals + 1e-9:
+                    return True, f"Correct! {a} {op_symbol} {b} = {exact}..., which rounds to {written}."
+                about = "about " if abs(float(exact) - expected) > 1e-9 else ""
+                return False, f"Check your calculation: {a} {op_symbol} {b} should equal {about}{exact}, not {written}"
             except (ValueError, ZeroDivisionError):
                 pass
     
@@ -160,7 +203,16 @@ def check_arithmetic(step: str) -> tuple[bool | None, str | None]:
 
 @app.post("/validate", response_model=ValidationResponse)
 async def validate_step(req: ValidationRequest):
-    """Validate a single math step using GPT-4o."""
+    """Validate a single math step, using GPT-4o only when check_arithmetic can't decide."""
+    ok, msg = check_arithmetic(req.currentStep)
+    if ok is not None:
+        return ValidationResponse(outcome="correct" if ok else "incorrect", feedback=msg)
+
+    key = cache_key(req.question, req.expectedAnswer, "\x1e".join(req.priorSteps), req.currentStep)
+    cached = validation_cache.get(key)
+    if cached is not None:
+        return cached
+
     prior_steps_text = "\n".join(f"{i+1}. {step}" for i, step in enumerate(req.priorSteps))
     
     user_message = f"""Problem: {req.question}
@@ -177,7 +229,7 @@ Evaluate this step and respond with JSON."""
 
     try:
         client = get_openai_client()
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": VALIDATION_SYSTEM_PROMPT},
@@ -187,12 +239,12 @@ Evaluate this step and respond with JSON."""
             temperature=0.3,
         )
         
-        import json
-        result = json.loads(response.choices[0].message.content)
-        return ValidationResponse(**result)
+        result = ValidationResponse(**json.loads(response.choices[0].message.content))
+        validation_cache[key] = result
+        return result
     
-    except Exception as e:
-        print(f"Validation error: {e}")
+    except Exception:
+        logger.exception("Validation error")
         return ValidationResponse(
             outcome="neutral",
             feedback="Unable to validate at this time. Continue working."
@@ -201,6 +253,11 @@ Evaluate this step and respond with JSON."""
 @app.post("/validate/final", response_model=FinalCheckResponse)
 async def check_final(req: FinalCheckRequest):
     """Check if the problem is fully solved."""
+    key = cache_key(req.question, req.expectedAnswer, "\x1e".join(req.allSteps))
+    cached = final_check_cache.get(key)
+    if cached is not None:
+        return cached
+
     steps_text = "\n".join(f"{i+1}. {step}" for i, step in enumerate(req.allSteps))
     
     user_message = f"""Problem: {req.question}
@@ -214,7 +271,7 @@ Has the student fully solved this problem? Respond with JSON."""
 
     try:
         client = get_openai_client()
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": FINAL_CHECK_SYSTEM_PROMPT},
@@ -224,12 +281,12 @@ Has the student fully solved this problem? Respond with JSON."""
             temperature=0.3,
         )
         
-        import json
-        result = json.loads(response.choices[0].message.content)
-        return FinalCheckResponse(**result)
+        result = FinalCheckResponse(**json.loads(response.choices[0].message.content))
+        final_check_cache[key] = result
+        return result
     
-    except Exception as e:
-        print(f"Final check error: {e}")
+    except Exception:
+        logger.exception("Final check error")
         return FinalCheckResponse(
             isSolved=False,
             feedback="Unable to check solution at this time."
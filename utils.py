@@ -1,54 +1,559 @@
 
 from __future__ import annotations
-import os, time, json, random, itertools, hashlib, threading
+import os, re, sys, io, mmap, struct, time, json, random, itertools, hashlib, threading, asyncio, atexit, importlib.util
+import httpx
+from collections import Counter
 from typing import Iterable, Dict, Any, Tuple, List
 from dataclasses import dataclass
-from config import RETRY_LIMIT
-from openai import OpenAI
+from config import RETRY_LIMIT, RATE_LIMIT_RPM, RATE_LIMIT_TPM, PROMPT_VARIANT, RAW_HTTP_REQUESTS, JSONL_IO_URING, LLM_NEGATIVE_TTL
+import llm_cache
+from openai import (OpenAI, AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError, APIStatusError,
+                    BadRequestError, AuthenticationError, PermissionDeniedError, NotFoundError, ConflictError, UnprocessableEntityError)
+from openai.types.chat import ChatCompletion
+from tenacity import Retrying, AsyncRetrying, retry_if_exception_type, stop_after_attempt
+from tenacity.wait import wait_base
+try:
+    import orjson
+except ImportError:  # stdlib json fallback; same records, just slower
+    orjson = None
 
-_client_singleton = None
-_client_lock = threading.Lock()
+# One pooled keep-alive connection set per client, so bursts reuse TLS sessions instead of
+# handshaking again. HTTP/2 (many requests per connection) only when the h2 package is installed.
+_HTTP2 = importlib.util.find_spec("h2") is not None
+_HTTP_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=100)
+_HTTP_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
 
+_UNSET = object()
+
+class Lazy:
+    """Process-wide value built on first call: `get_x = Lazy(build)`, then `get_x()`. Each instance
+       has its own lock, so first builds of unrelated resources don't wait on each other, and a
+       racing first call can't build a second copy. A build returning None is cached too."""
+    __slots__ = ("f", "v", "l")
+
+    def __init__(self, f):
+        self.f, self.v, self.l = f, _UNSET, threading.Lock()
+
+    def __call__(self):
+        v = self.v
+        if v is _UNSET:
+            with self.l:
+                if self.v is _UNSET:
+                    self.v = self.f()
+                v = self.v
+        return v
+
+# max_retries=0: with_backoff/with_backoff_async are the only retry layer. SDK retries would multiply
+# attempts and bypass the RateLimiter, and the RAW_HTTP_REQUESTS path has none.
+@Lazy
 def get_client() -> OpenAI:
-    global _client_singleton
-    if _client_singleton is None:
-        with _client_lock:
-            if _client_singleton is None:
-                _client_singleton = OpenAI()
-    return _client_singleton
+    return OpenAI(max_retries=0, http_client=httpx.Client(http2=_HTTP2, limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT))
+
+@Lazy
+def get_async_http() -> httpx.AsyncClient:
+    """Connection pool behind get_async_client(); also used directly by the RAW_HTTP_REQUESTS path."""
+    return httpx.AsyncClient(http2=_HTTP2, limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT)
+
+@Lazy
+def get_async_client() -> AsyncOpenAI:
+    """Shared AsyncOpenAI client; create and use it inside a single asyncio.run()."""
+    return AsyncOpenAI(max_retries=0, http_client=get_async_http())
 
 # ---------- JSONL helpers ---------
+def _dumps(rec: dict) -> bytes:
+    if orjson is not None:
+        # OPT_NON_STR_KEYS: int keys (e.g. rank maps) become strings, as json.dumps does
+        return orjson.dumps(rec, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(rec, ensure_ascii=False).encode("utf-8")
+
+def _loads(line: bytes):
+    return orjson.loads(line) if orjson is not None else json.loads(line)
+
+# One O_APPEND handle per path (JSONL or framed), kept open for the life of the process. Appends land
+# in a 1 MiB buffer under the path's lock; flush_jsonl() pushes them to the OS and fsyncs at checkpoints.
+_jsonl_handles: Dict[str, Tuple[io.BufferedWriter, threading.Lock]] = {}
+_jsonl_handles_lock = threading.Lock()
+
+def _append_handle(path: str) -> Tuple[io.BufferedWriter, threading.Lock]:
+    key = os.path.abspath(path)
+    h = _jsonl_handles.get(key)
+    if h is None:
+        with _jsonl_handles_lock:
+            h = _jsonl_handles.get(key)
+            if h is None:
+                # O_CLOEXEC is Python's default for os.open (PEP 446); spelled out so the intent survives edits
+                fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_CLOEXEC", 0), 0o644)
+                h = _jsonl_handles[key] = (_uring_appender(fd) or io.BufferedWriter(io.FileIO(fd, "a"), buffer_size=1 << 20), threading.Lock())
+    return h
+
+# ---- Optional io_uring backend (JSONL_IO_URING=1, Linux >= 5.6, `pip install liburing`) ----
+class _UringAppender:
+    """Stand-in for the BufferedWriter above: buffers appends and, on flush, submits them as linked
+       IORING_OP_WRITE SQEs (up to DEPTH per io_uring_enter) instead of one write() each."""
+    DEPTH = 128
+
+    def __init__(self, fd: int, buffer_size: int = 1 << 20):
+        import liburing
+        self.lib, self.fd, self.buffer_size = liburing, fd, buffer_size
+        self.pending: List[bytes] = []
+        self.size = 0
+        self.ring, self.cqe = liburing.Ring(), liburing.Cqe()
+        liburing.io_uring_queue_init(self.DEPTH, self.ring)
+
+    def write(self, b: bytes):
+        self.pending.append(b)
+        self.size += len(b)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        lib = self.lib
+        while self.pending:
+            batch, self.pending = self.pending[:self.DEPTH], self.pending[self.DEPTH:]
+            for n, b in enumerate(batch):
+                sqe = lib.io_uring_get_sqe(self.ring)
+                lib.io_uring_prep_write(sqe, self.fd, b)  # O_APPEND: the kernel picks the offset
+                if n < len(batch) - 1:
+                    lib.io_uring_sqe_set_flags(sqe, lib.IOSQE_IO_LINK)  # records land in submission order
+            lib.io_uring_submit_and_wait(self.ring, len(batch))
+            err = None
+            for b in batch:
+                lib.io_uring_wait_cqe(self.ring, self.cqe)
+                res = self.cqe[0].res
+                lib.io_uring_cqe_seen(self.ring, self.cqe[0])
+                if err is None and (res is None or res < len(b)):
+                    err = OSError(-res, os.strerror(-res)) if res and res < 0 else OSError(f"short io_uring write ({res} of {len(b)} bytes)")
+            if err is not None:
+                raise err
+        self.size = 0
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.lib.io_uring_queue_exit(self.ring)
+            os.close(self.fd)
+
+def _kernel_at_least(major: int, minor: int) -> bool:
+    m = re.match(r"(\d+)\.(\d+)", os.uname().release)  # compare numerically: "5.10" > "5.6"
+    return bool(m) and (int(m.group(1)), int(m.group(2))) >= (major, minor)
+
+_uring_ok = JSONL_IO_URING  # cleared after the first failed setup, so it is reported once
+
+def _uring_appender(fd: int):
+    """_UringAppender for fd when enabled and usable here, else None (caller uses BufferedWriter)."""
+    global _uring_ok
+    if not _uring_ok:
+        return None
+    try:
+        if not (sys.platform.startswith("linux") and _kernel_at_least(5, 6)):
+            raise OSError("needs Linux >= 5.6")
+        return _UringAppender(fd)
+    except Exception as e:  # missing binding, old kernel, or io_uring blocked (e.g. by seccomp)
+        print(f"io_uring appends disabled ({e}); using buffered writes")
+        _uring_ok = False
+        return None
+
 def append_jsonl(path: str, recs: Iterable[dict]):
-    with open(path, "a", encoding="utf-8") as f:
-        for r in recs:
-            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    # Serialize everything first, then one buffered write for the whole batch; not durable until flush_jsonl
+    lines = [_dumps(r) for r in recs]
+    if not lines: return
+    bw, lock = _append_handle(path)
+    with lock:
+        bw.write(b"\n".join(lines) + b"\n")
+
+def flush_jsonl(path: str, fsync: bool = True):
+    """Checkpoint: write out buffered appends for `path` and (by default) fsync them."""
+    h = _jsonl_handles.get(os.path.abspath(path))
+    if h is None: return
+    bw, lock = h
+    with lock:
+        bw.flush()
+        if fsync:
+            os.fsync(bw.fileno())
+
+def close_jsonl(path: str):
+    """Flush and drop the append handle for `path` (before deleting or handing the file off)."""
+    h = _jsonl_handles.pop(os.path.abspath(path), None)
+    if h is None: return
+    bw, lock = h
+    with lock:
+        bw.close()
+
+@atexit.register
+def _close_all_jsonl():
+    for path in list(_jsonl_handles):
+        close_jsonl(path)
 
 def read_jsonl(path: str) -> Iterable[dict]:
+    flush_jsonl(path, fsync=False)  # see our own buffered appends
     if not os.path.exists(path): return []
-    with open(path, "r", encoding="utf-8") as f:
+    # The buffered binary line iterator beats both an mmap find() loop and splitting whole blocks;
+    # the per-record cost is _loads, not finding newlines.
+    with open(path, "rb", buffering=1 << 20) as f:
         for line in f:
             line = line.strip()
             if line:
-                yield json.loads(line)
+                yield _loads(line)
+
+# ---------- Framed records ----------
+# Internal caches: each record is a 4-byte little-endian length then its JSON bytes, so a reader
+# steps record to record by offset instead of scanning for newlines. Not meant for human eyes.
+_FRAME = struct.Struct("<I")
+
+def append_framed(path: str, recs: Iterable[dict]):
+    buf = b"".join(_FRAME.pack(len(b)) + b for b in map(_dumps, recs))
+    if not buf: return
+    bw, lock = _append_handle(path)
+    with lock:
+        bw.write(buf)
+
+def read_framed(path: str) -> Iterable[dict]:
+    flush_jsonl(path, fsync=False)
+    if not os.path.exists(path) or os.path.getsize(path) == 0: return []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        off, size = 0, len(mm)
+        while off + 4 <= size:
+            (n,) = _FRAME.unpack_from(mm, off)
+            if off + 4 + n > size:
+                break
+            yield _loads(mm[off + 4 : off + 4 + n])
+            off += 4 + n
+    if off < size:
+        # Torn tail from a crash mid-append; cut it so the next append stays aligned
+        os.truncate(path, off)
 
 def count_jsonl(path: str) -> int:
+    # Newlines counted in 1 MiB blocks (bytes.count is memchr-speed); assumes no blank lines,
+    # which append_jsonl never writes. A final record without a trailing newline still counts.
+    flush_jsonl(path, fsync=False)
     if not os.path.exists(path): return 0
-    with open(path, "r", encoding="utf-8") as f:
-        return sum(1 for _ in f if _.strip())
+    n, last = 0, b"\n"
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            b = f.read(1 << 20)
+            if not b: break
+            n += b.count(b"\n")
+            last = b[-1:]
+    return n if last == b"\n" else n + 1
 
 # ---------- Backoff wrapper ----------
-def with_backoff(call, *, max_attempts: int = RETRY_LIMIT, base_delay=0.5, jitter=0.2):
-    for attempt in range(1, max_attempts + 1):
+# Transient failures only; anything else (bad request, auth, parse errors) surfaces immediately.
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+class wait_retry_after(wait_base):
+    """Extra wait taken from the retry-after header of the OpenAI error that failed the attempt."""
+    def __call__(self, retry_state) -> float:
+        exc = retry_state.outcome.exception() if retry_state.outcome else None
+        resp = getattr(exc, "response", None)
+        if resp is None: return 0.0
+        return _parse_reset(resp.headers.get("retry-after")) or 0.0
+
+# Per-thread generator for jitter: no shared Mersenne Twister state across retrying threads
+_tls = threading.local()
+
+def _rng() -> random.Random:
+    rng = getattr(_tls, "rng", None)
+    if rng is None:
+        rng = _tls.rng = random.Random(os.urandom(8))
+    return rng
+
+class wait_decorrelated_jitter(wait_base):
+    """AWS-style decorrelated jitter: sleep = min(cap, uniform(base, 3 * previous sleep)).
+       Retriers that failed together spread out instead of waking in lockstep."""
+    def __init__(self, base: float = 0.5, cap: float = 30.0):
+        self.base, self.cap = base, cap
+
+    def __call__(self, retry_state) -> float:
+        prev = getattr(retry_state, "decorrelated_prev", self.base)
+        sleep = min(self.cap, _rng().uniform(self.base, prev * 3))
+        retry_state.decorrelated_prev = sleep  # per-call state; RetryCallState lives for one call
+        return sleep
+
+def _retry_policy(max_attempts: int) -> dict:
+    return dict(
+        retry=retry_if_exception_type(RETRYABLE_ERRORS),
+        # retry-after is added on top, so callers released by the same header still don't wake together
+        wait=wait_decorrelated_jitter(base=0.5, cap=30.0) + wait_retry_after(),
+        stop=stop_after_attempt(max_attempts),
+        reraise=True,
+    )
+
+def with_backoff(call, *, max_attempts: int = RETRY_LIMIT):
+    return Retrying(**_retry_policy(max_attempts))(call)
+
+async def with_backoff_async(call, *, max_attempts: int = RETRY_LIMIT):
+    """Same policy as with_backoff; waits don't block the loop. `call` must be an `async def`
+       (tenacity only awaits coroutine functions, not lambdas returning coroutines)."""
+    return await AsyncRetrying(**_retry_policy(max_attempts))(call)
+
+async def map_bounded(coros: Iterable, concurrency: int = 64) -> list:
+    """gather() with at most `concurrency` of `coros` running at once; results keep input order."""
+    sem = asyncio.Semaphore(concurrency)
+    async def one(c):
+        async with sem:
+            return await c
+    return await asyncio.gather(*[one(c) for c in coros])
+
+# ---------- Rate limiter ----------
+def _parse_reset(v: str | None) -> float | None:
+    """Parse OpenAI durations like '1s', '6m0s', '250ms' (or plain seconds) into seconds."""
+    if not v: return None
+    try:
+        return float(v)
+    except ValueError:
+        pass
+    total, num = 0.0, ""
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    i = 0
+    while i < len(v):
+        c = v[i]
+        if c.isdigit() or c == ".":
+            num += c; i += 1; continue
+        unit = "ms" if v.startswith("ms", i) else c
+        if unit not in units or not num: return None
+        total += float(num) * units[unit]; num = ""; i += len(unit)
+    return total
+
+_encoder = None
+_system_token_counts: Dict[str, int] = {}
+
+def _count_tokens(text: str) -> int:
+    global _encoder
+    if _encoder is None:
         try:
-            return call()
-        except Exception as e:
-            if attempt == max_attempts:
-                raise
-            sleep = base_delay * (2 ** (attempt - 1)) + random.random() * jitter
-            time.sleep(sleep)
+            import tiktoken
+            _encoder = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _encoder = False
+    # encode_ordinary: item text containing e.g. "<|endoftext|>" is plain text here, not a ValueError
+    return len(_encoder.encode_ordinary(text)) if _encoder else len(text) // 4 + 1
+
+def estimate_tokens(messages: List[dict], max_tokens: int) -> int:
+    """Upper-bound tokens a chat call will charge against TPM (prompt + max completion)."""
+    n = 0
+    for m in messages:
+        if m["role"] == "system":
+            # The same few multi-KB system prompts on every call: tokenize each once
+            c = _system_token_counts.get(m["content"])
+            if c is None:
+                if len(_system_token_counts) >= 16: _system_token_counts.clear()  # skill prompts change when examples refresh
+                c = _system_token_counts[m["content"]] = _count_tokens(m["content"])
+            n += c
+        else:
+            n += _count_tokens(m["content"])
+    return n + 4 * len(messages) + max_tokens
+
+class RateLimiter:
+    """Two token buckets (requests, tokens) refilled continuously at the per-minute rate.
+    Response headers snap the buckets to the server's view; 429s pause every caller for retry-after."""
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm, self.tpm = float(rpm), float(tpm)
+        self.requests, self.tokens = self.rpm, self.tpm
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        dt = now - self.updated
+        self.updated = now
+        self.requests = min(self.rpm, self.requests + dt * self.rpm / 60.0)
+        self.tokens = min(self.tpm, self.tokens + dt * self.tpm / 60.0)
+
+    async def acquire(self, tokens: int = 0):
+        tokens = min(tokens, self.tpm)
+        async with self._lock:  # FIFO: the head waiter sleeps while holding it
+            while True:
+                self._refill()
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0:
+                    if self.requests >= 1 and self.tokens >= tokens:
+                        self.requests -= 1
+                        self.tokens -= tokens
+                        return
+                    wait = max((1 - self.requests) * 60.0 / self.rpm, (tokens - self.tokens) * 60.0 / self.tpm)
+                await asyncio.sleep(wait)
+
+    def update(self, headers):
+        """Adopt x-ratelimit-limit-* / x-ratelimit-remaining-* from an OpenAI response."""
+        self._refill()
+        for kind in ("requests", "tokens"):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            try:
+                if limit: setattr(self, "rpm" if kind == "requests" else "tpm", float(limit))
+                if remaining: setattr(self, kind, min(getattr(self, kind), float(remaining)))
+            except ValueError:
+                pass
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+# OpenAI limits (and the x-ratelimit-* headers) are per model, so each model gets its own buckets;
+# one shared limiter would adopt whichever model answered last.
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(model: str) -> RateLimiter:
+    rl = _rate_limiters.get(model)
+    if rl is None:
+        with _rate_limiters_lock:
+            rl = _rate_limiters.get(model)
+            if rl is None:
+                rl = _rate_limiters[model] = RateLimiter(RATE_LIMIT_RPM, RATE_LIMIT_TPM)
+    return rl
+
+# ---------- Raw request path (RAW_HTTP_REQUESTS=1) ----------
+# The body is serialized with orjson and posted straight through the shared httpx pool. System
+# prompts (the same few multi-KB strings on every call) are JSON-encoded once, so only the per-item
+# user text is encoded per request. Every pipeline request is [system, user] with a handful of scalar
+# options, so the body is spliced from bytes built once per (model, system) and per option set:
+# PREFIX + dumps(user) + SUFFIX. Anything else is encoded whole.
+_body_prefixes: Dict[Tuple[str, str], bytes] = {}
+_body_suffixes: Dict[tuple, bytes] = {}
+
+def _spliced_request_bytes(kwargs: dict) -> bytes | None:
+    msgs = kwargs["messages"]
+    if len(msgs) != 2 or msgs[0]["role"] != "system" or msgs[1]["role"] != "user" or len(msgs[0]) != 2 or len(msgs[1]) != 2:
+        return None
+    rest = tuple((k, v) for k, v in kwargs.items() if k not in ("model", "messages"))
+    try:
+        suffix = _body_suffixes.get(rest)
+    except TypeError:  # unhashable option (e.g. a response_format dict): encode the whole body
+        return None
+    if suffix is None:
+        if len(_body_suffixes) >= 64: _body_suffixes.clear()
+        opts = orjson.dumps(dict(rest))
+        suffix = _body_suffixes[rest] = b"}]" + (b"," + opts[1:] if len(opts) > 2 else b"}")
+    pkey = (kwargs["model"], msgs[0]["content"])
+    prefix = _body_prefixes.get(pkey)
+    if prefix is None:
+        if len(_body_prefixes) >= 16: _body_prefixes.clear()  # skill prompts change when examples refresh
+        prefix = _body_prefixes[pkey] = (b'{"model":' + orjson.dumps(pkey[0]) + b',"messages":[{"role":"system","content":'
+                                         + orjson.dumps(pkey[1]) + b'},{"role":"user","content":')
+    return prefix + orjson.dumps(msgs[1]["content"]) + suffix
+
+def _request_bytes(kwargs: dict) -> bytes:
+    spliced = _spliced_request_bytes(kwargs)
+    return spliced if spliced is not None else orjson.dumps(kwargs)
+
+_STATUS_ERRORS = {400: BadRequestError, 401: AuthenticationError, 403: PermissionDeniedError, 404: NotFoundError,
+                  409: ConflictError, 422: UnprocessableEntityError, 429: RateLimitError}
+
+class _RawChatResponse:
+    """Same surface limited_create uses from the SDK's with_raw_response: .headers and .parse()."""
+    def __init__(self, resp: httpx.Response):
+        self.headers = resp.headers
+        self._resp = resp
+
+    def parse(self) -> ChatCompletion:
+        return ChatCompletion.model_validate(orjson.loads(self._resp.content))
+
+async def _raw_chat_create(client: AsyncOpenAI, kwargs: dict) -> _RawChatResponse:
+    headers = {"Authorization": f"Bearer {client.api_key}", "Content-Type": "application/json"}
+    if client.organization: headers["OpenAI-Organization"] = client.organization
+    if client.project: headers["OpenAI-Project"] = client.project
+    url = str(client.base_url).rstrip("/") + "/chat/completions"
+    try:
+        resp = await get_async_http().post(url, content=_request_bytes(kwargs), headers=headers)
+    except httpx.TimeoutException as e:
+        raise APITimeoutError(request=e.request) from e
+    except httpx.TransportError as e:
+        raise APIConnectionError(request=e.request) from e
+    if resp.status_code >= 400:
+        # Same exception types as the SDK, so RETRYABLE_ERRORS and the 429 handling still apply
+        cls = InternalServerError if resp.status_code >= 500 else _STATUS_ERRORS.get(resp.status_code, APIStatusError)
+        try:
+            body = orjson.loads(resp.content)
+        except orjson.JSONDecodeError:
+            body = None
+        err = body.get("error") if isinstance(body, dict) else None
+        msg = err.get("message") if isinstance(err, dict) else resp.text
+        raise cls(f"Error code: {resp.status_code} - {msg}", response=resp, body=body)
+    return _RawChatResponse(resp)
+
+async def limited_create(client: AsyncOpenAI, **kwargs):
+    """One chat.completions.create attempt gated by the model's RateLimiter; wrap in with_backoff_async."""
+    limiter = get_rate_limiter(kwargs["model"])
+    await limiter.acquire(estimate_tokens(kwargs["messages"], kwargs.get("max_tokens") or 0))
+    try:
+        if RAW_HTTP_REQUESTS and orjson is not None:
+            raw = await _raw_chat_create(client, kwargs)
+        else:
+            raw = await client.chat.completions.with_raw_response.create(**kwargs)
+    except RateLimitError as e:
+        headers = e.response.headers
+        limiter.update(headers)
+        limiter.pause(_parse_reset(headers.get("retry-after")) or _parse_reset(headers.get("x-ratelimit-reset-tokens")) or 1.0)
+        raise
+    limiter.update(raw.headers)
+    resp = raw.parse()
+    record_usage(resp)
+    return resp
+
+# Failures tied to the request itself (bad input, context length, unknown model). The retry policy
+# already gives up on them after one attempt; cached_completion also remembers them for LLM_NEGATIVE_TTL.
+# Auth and permission errors aren't request-specific, so they are raised but not cached.
+PERMANENT_ERRORS = (BadRequestError, NotFoundError, UnprocessableEntityError)
+
+class CachedFailure(RuntimeError):
+    """The same request failed permanently less than LLM_NEGATIVE_TTL seconds ago."""
+
+async def cached_completion(client: AsyncOpenAI, *, namespace: str = "", **kwargs) -> str:
+    """Response text for a chat.completions request. Served from llm_cache when the same
+       model/system/user was answered before; otherwise limited_create under with_backoff_async.
+       Raises CachedFailure without calling the API if the request recently failed permanently."""
+    msgs = kwargs["messages"]
+    system = "".join(m["content"] for m in msgs if m["role"] == "system")
+    user = "".join(m["content"] for m in msgs if m["role"] == "user")
+    key = llm_cache.request_key(kwargs["model"], system, user, namespace)
+    text = llm_cache.get(key)
+    if text is not None:
+        usage_stats["llm_cache_hits"] += 1
+        return text
+    # A 400 can come from an option (max_tokens, logprobs, ...), so failures are keyed on those too
+    fail_key = llm_cache.request_key(kwargs["model"], system, user, namespace,
+                                     {k: v for k, v in kwargs.items() if k not in ("model", "messages")})
+    failed = llm_cache.get_failure(fail_key)
+    if failed is not None:
+        usage_stats["llm_negative_hits"] += 1
+        raise CachedFailure(failed)
+    async def _call():
+        return await limited_create(client, **kwargs)
+    try:
+        resp = await with_backoff_async(_call)
+    except PERMANENT_ERRORS as e:
+        llm_cache.put_failure(fail_key, f"{type(e).__name__}: {e}", LLM_NEGATIVE_TTL)
+        raise
+    text = resp.choices[0].message.content or ""
+    llm_cache.put(key, text)
+    return text
+
+# ---------- Usage counters ----------
+usage_stats: Counter = Counter()
+
+def record_usage(resp):
+    """Accumulate token usage, including prompt tokens served from OpenAI's prefix cache."""
+    u = getattr(resp, "usage", None)
+    if u is None: return
+    usage_stats["requests"] += 1
+    usage_stats["prompt_tokens"] += u.prompt_tokens or 0
+    usage_stats["completion_tokens"] += u.completion_tokens or 0
+    details = getattr(u, "prompt_tokens_details", None)
+    usage_stats["cached_tokens"] += getattr(details, "cached_tokens", 0) or 0
+
+def usage_summary() -> str:
+    p, c = usage_stats["prompt_tokens"], usage_stats["cached_tokens"]
+    hit = 100.0 * c / p if p else 0.0
+    return (f"{usage_stats['requests']} requests, {p} prompt tokens ({c} cached, {hit:.1f}%), "
+            f"{usage_stats['completion_tokens']} completion tokens")
 
 # ---------- Prompt builders ----------
-SKILL_SYSTEM_TEMPLATE = """You are a skill tagger for math word problems.
+SKILL_SYSTEM_TEMPLATE_FULL = """You are a skill tagger for math word problems.
 You read a problem and its solution, then output a concise, comma-separated list of skill tags
 (e.g., "division, unit conversion, proportional reasoning").
 - Invent new tags when helpful. Prefer 1–4 words per tag.
@@ -58,22 +563,34 @@ You read a problem and its solution, then output a concise, comma-separated list
 - Do not include difficulty in tags.
 """
 
-def build_skill_user(problem: str, solution: str, examples: List[Tuple[str,str,List[str]]] | None) -> str:
-    example_text = ""
-    if examples:
-        blocks = []
-        for (p, a, tags) in examples:
-            blocks.append(f"Example:\nQ: {p}\nA: {a}\nTAGS: {', '.join(tags)}")
-        example_text = "\n\n".join(blocks) + "\n\n"
+SKILL_SYSTEM_TEMPLATE_COMPACT = """Tag the skills a math word problem+solution uses.
+Output: comma-separated tags, 1–4 words each (e.g. "division, unit conversion, proportional reasoning").
+- Reuse example tags when they fit; new tags OK.
+- No near-duplicates ("multiplication"/"multiply").
+- General concepts over fine-grained steps.
+- No difficulty words.
+"""
+
+def build_skill_system(examples: List[Tuple[str,str,List[str]]] | None, template: str | None = None) -> str:
+    """System message = fixed instructions + few-shot examples. Keep `examples` frozen for a run so
+       this prefix is byte-identical across calls and OpenAI's automatic prompt caching applies."""
+    template = template or SKILL_SYSTEM_TEMPLATE
+    if not examples:
+        return template
+    ex = "\n\n".join(f"Example:\nQ: {p}\nA: {a}\nTAGS: {', '.join(tags)}" for (p, a, tags) in examples)
+    return template + "\n" + ex + "\n"
+
+def build_skill_user(problem: str, solution: str) -> str:
     return (
-        example_text +
         "Now tag this item.\n"
         f"Q: {problem}\n"
         f"A: {solution}\n"
         "Return only the tags, comma-separated."
     )
 
-DIFF_SYSTEM_TEMPLATE = """You are a judge comparing the relative difficulty of TWO grade‑school math problem+solution pairs.
+# Long on purpose: the rubric pushes the shared prefix past OpenAI's 1024-token prompt-cache threshold.
+# Edit it rarely — any byte change invalidates the cached prefix for in-flight runs.
+DIFF_SYSTEM_TEMPLATE_FULL = """You are a judge comparing the relative difficulty of TWO grade‑school math problem+solution pairs.
 Assess difficulty for a typical grade‑school student (ages ~8–12). Consider these heuristics:
 - Number of reasoning steps
 - Presence of multi-step arithmetic (esp. with carrying/borrowing) or unit conversions
@@ -81,13 +598,99 @@ Assess difficulty for a typical grade‑school student (ages ~8–12). Consider
 - Linguistic complexity and distractors
 - Requirement to combine skills
 
-Output a single character:
+Rubric (apply in this order; later items only break ties left by earlier ones):
+
+1. Reasoning steps. Count the distinct operations a student must plan, not the lines the solution
+   happens to use. "Find the total, then split it evenly" is two steps even if written on one line.
+   Re-reading a given value is not a step. Checking work is not a step. A step that must be
+   undone or reversed (working backwards from a result to a starting amount) counts double,
+   because students find inverse reasoning much harder than forward reasoning.
+
+2. Planning load. A problem is harder when the student must decide WHAT to compute rather than
+   just carry out an obvious operation. Signs of planning load: an unknown that must be named
+   and solved for; an intermediate quantity that is never mentioned in the question; a need to
+   compare two scenarios; a constraint that must hold at the same time as another; a question
+   that asks for something other than the most natural quantity (e.g. "how many more", "what
+   fraction of the remainder", "how much did each person pay after the refund").
+
+3. Number sense. Whole numbers below 100 are easiest, then larger whole numbers, then money and
+   simple decimals, then fractions with like denominators, then unlike denominators, mixed
+   numbers, percentages and ratios, then negative numbers and rates built from other rates.
+   Multi-digit multiplication and long division with remainders add load; carrying and borrowing
+   across several columns add load. Large numbers alone do not make a problem hard if the
+   operation is a single obvious step.
+
+4. Units and conversions. Same-unit arithmetic is easiest. One conversion (minutes to hours,
+   cents to dollars) adds a step. Chained conversions, compound units (km per hour, dollars per
+   pound), and area or volume units add more. Time arithmetic that crosses noon, midnight, or
+   an hour boundary counts as a conversion.
+
+5. Concepts. Rough order from easiest to hardest: counting and single-operation arithmetic;
+   comparison and "how many more"; equal sharing and grouping; multi-step whole-number problems;
+   money and change; elapsed time; perimeter and area of rectangles; fractions of a quantity;
+   averages; percentages, discounts and interest; ratios and proportional reasoning; simple
+   linear equations; rates, work and mixture problems; geometry beyond rectangles; problems
+   that combine three or more of these.
+
+6. Language. Long text is not harder by itself. It is harder when it contains distractors
+   (numbers or facts that are not needed), indirect phrasing ("twice as many as three less
+   than"), quantities introduced out of order, or a question that is easy to misread.
+
+7. The solution. Use the provided solution to see how the problem is actually resolved, but judge
+   the problem for a student, not the solution's writing style. A verbose solution to a simple
+   problem is still simple. If the solution uses algebra where arithmetic would do, judge by
+   the simplest reasonable method. If the solution looks wrong, judge by the intended problem.
+
+8. Multiple answers. A problem that asks for two or more quantities is harder than one that asks
+   for one of them, unless the second answer falls out of the first with no extra work.
+
+Common mistakes to avoid:
+- Rating a problem harder only because it is longer, uses bigger numbers, or tells a story.
+- Rating a problem easier only because its solution is short; a short solution can hide an insight.
+- Letting the order of the pair influence the verdict; swapping FIRST and SECOND must flip '<' and '>'.
+- Treating familiar contexts (shopping, sports) as easier than unfamiliar ones with the same math.
+
+Calibration anchors:
+- Very easy: "Tom has 5 apples and buys 3 more. How many does he have?" (one step, small numbers)
+- Easy: "A box holds 24 pencils. How many pencils are in 7 boxes?" (one step, larger product)
+- Medium: "Sara buys 3 notebooks at $2.45 each and pays with a $10 bill. What is her change?"
+  (two steps, money decimals)
+- Hard: "After spending 1/3 of her money on books and 1/4 of the rest on lunch, Ana has $18 left.
+  How much did she start with?" (fractions of a remainder, working backwards)
+- Very hard: "Two pipes fill a tank in 6 and 9 hours; a drain empties it in 12 hours. With all three
+  open, how long does it take to fill the tank?" (combined rates, fractions, planning)
+
+Ties. Use '=' only when the two problems would take a typical student about the same effort and
+you would expect similar success rates. Do not use '=' to avoid a decision: if one problem has a
+clearly extra step, an extra conversion, or a harder number type, pick it as harder. Judge each
+comparison independently; ignore any earlier comparisons and the order in which pairs appear.
+
+Output, for each comparison, exactly one symbol:
 - '<' if the FIRST pair is EASIER than the second
 - '>' if the FIRST pair is HARDER than the second
 - '=' if they are roughly the same difficulty
+When several pairs are given, output one symbol per pair in the order given, separated by spaces.
 No extra text.
 """
 
+# ~10x shorter than the full rubric; below the prompt-cache threshold, so it wins on cold or
+# cache-miss traffic rather than on cached prefixes.
+DIFF_SYSTEM_TEMPLATE_COMPACT = """Judge the relative difficulty of two grade‑school math problem+solution pairs for a typical student (ages ~8–12).
+Harder: more reasoning steps; multi-step arithmetic (carrying/borrowing); fractions, decimals, percents;
+unit conversions; forming equations, ratios, rates, geometry; working backwards; distractors or indirect
+wording; combining skills.
+Not harder by itself: longer text, big numbers in one obvious step, a verbose solution.
+Use '=' only for genuinely similar effort; pair order must not matter.
+Per comparison output one symbol: '<' FIRST easier, '>' FIRST harder, '=' about the same.
+Several pairs: one symbol per pair, in order, space-separated. No other text.
+"""
+
+SYSTEM_TEMPLATES = {
+    "full":    (SKILL_SYSTEM_TEMPLATE_FULL, DIFF_SYSTEM_TEMPLATE_FULL),
+    "compact": (SKILL_SYSTEM_TEMPLATE_COMPACT, DIFF_SYSTEM_TEMPLATE_COMPACT),
+}
+SKILL_SYSTEM_TEMPLATE, DIFF_SYSTEM_TEMPLATE = SYSTEM_TEMPLATES[PROMPT_VARIANT]
+
 def build_diff_user(p1: str, a1: str, p2: str, a2: str) -> str:
     return (
         "FIRST:\n"
@@ -97,8 +700,54 @@ def build_diff_user(p1: str, a1: str, p2: str, a2: str) -> str:
         "Is the first easier (<), harder (>), or about the same (=)? Return exactly one of '<', '>', '='."
     )
 
+def build_diff_user_batch(pairs: List[Tuple[str,str,str,str]]) -> str:
+    """Several independent comparisons in one message; the answer is one symbol per pair, in order."""
+    blocks = []
+    for n, (p1, a1, p2, a2) in enumerate(pairs, start=1):
+        blocks.append(
+            f"Pair {n}:\n"
+            "FIRST:\n"
+            f"Q1: {p1}\nA1: {a1}\n"
+            "SECOND:\n"
+            f"Q2: {p2}\nA2: {a2}"
+        )
+    return (
+        "Judge each pair below independently.\n\n" +
+        "\n\n".join(blocks) + "\n\n"
+        f"Return exactly {len(pairs)} symbols from <, >, = (one per pair, in order, separated by single spaces): "
+        "'<' if the first is easier, '>' if harder, '=' if about the same. No other text."
+    )
+
+def parse_diff_batch(text: str, k: int) -> List[str] | None:
+    # Tolerant: ignores spacing, numbering or stray text; only the count of symbols must match
+    syms = [c for c in text if c in "<>="]
+    return syms if len(syms) == k else None
+
+SCORE_SYSTEM_TEMPLATE = """You rate the difficulty of ONE grade‑school math problem+solution pair for a typical
+grade‑school student (ages ~8–12) on a scale from 1 to 10.
+- 1: a single obvious step with small whole numbers
+- 4: two or three steps, or money/decimals, or one unit conversion
+- 7: fractions or percentages of a quantity, working backwards, or forming a simple equation
+- 10: many steps combining several skills (rates, ratios, fractions of a remainder, equations)
+Consider the number of reasoning steps, number types, unit conversions, planning needed, and
+distractors in the wording. Judge the problem, not the length or style of the solution.
+Output only the integer. No extra text.
+"""
+
+def build_score_user(problem: str, solution: str) -> str:
+    return (
+        f"Q: {problem}\n"
+        f"A: {solution}\n\n"
+        "Difficulty from 1 (easiest) to 10 (hardest)? Return only the integer."
+    )
+
 # --------- Comparison cache key ---------
-def pair_key(i: int, j: int) -> str:
+def pair_key(i: int, j: int) -> int:
+    """Order-free key for a pair of item indices: (min << 32) | max. Ints hash as themselves, so
+       this is cheaper than a formatted string and needs no memoizing."""
     if i <= j:
-        return f"{i}|{j}"
-    return f"{j}|{i}"
+        return (i << 32) | j
+    return (j << 32) | i
+
+def unpack_pair_key(k: int) -> Tuple[int, int]:
+    return k >> 32, k & 0xFFFFFFFF